@@ -1,8 +1,15 @@
 import os
-import re # Import the regular expression module for sanitization
-from firecrawl import FirecrawlApp
+import asyncio
+import time
+import random
+import json
+import aiohttp
 from dotenv import load_dotenv
 from urllib.parse import urlparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from functools import lru_cache
 import tldextract
 
 # --- Load Environment Variables ---
@@ -14,6 +21,9 @@ print("📦 Attempting to load environment variables from .env file.")
 # Get configuration from environment variables (loaded from .env or system)
 API_KEY = os.getenv("FIRECRAWL_API_KEY")
 API_URL = os.getenv("API_URL")
+# Accept Firecrawl's cached copy of a page if it is younger than this (in ms).
+# Defaults to 1 day; set FIRECRAWL_MAX_AGE=0 to always force a fresh scrape.
+MAX_AGE_MS = os.getenv("FIRECRAWL_MAX_AGE", "86400000") # Validated below
 
 INPUT_FILENAME = "links.txt"
 
@@ -22,10 +32,19 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 MAIN_OUTPUT_FOLDER_NAME = "output" # Name for the main output folder
 MAIN_OUTPUT_DIRECTORY = os.path.join(SCRIPT_DIR, MAIN_OUTPUT_FOLDER_NAME)
 
+# Maximum length of generated output filenames (some OS limits)
+MAX_FILENAME_LEN = 200 # A common safe limit, adjust if needed
+MAX_FILENAME_BASE_LEN = MAX_FILENAME_LEN - len('.md') # Room left for the name before the extension
+
 # Define characters to replace in the URL path for filenames
 # Common problematic characters across file systems: / \ : * ? " < > |
-# We'll replace them with underscores
-REPLACE_CHARS_PATTERN = re.compile(r'[\/:*?"<>|]')
+# We'll replace them with underscores (str.translate does this in a single pass)
+REPLACE_CHARS_TABLE = str.maketrans({char: '_' for char in '/\\:*?"<>|'})
+
+# Reusable domain extractor. It uses the bundled public suffix list snapshot
+# instead of fetching the list over the network, and skips the on-disk cache.
+TLD_EXTRACTOR = tldextract.TLDExtract(suffix_list_urls=(), fallback_to_snapshot=True,
+                                      cache_dir=None, include_psl_private_domains=False)
 
 def sanitize_url_path_for_filename(path):
     """Sanitizes a URL path to be safe for use as a filename base."""
@@ -37,7 +56,7 @@ def sanitize_url_path_for_filename(path):
     sanitized_path = path.strip('/')
 
     # Replace problematic characters with underscore
-    sanitized_path = REPLACE_CHARS_PATTERN.sub('_', sanitized_path)
+    sanitized_path = sanitized_path.translate(REPLACE_CHARS_TABLE)
 
     # Optional: Replace sequences of underscores with a single underscore
     # sanitized_path = re.sub(r'_{2,}', '_', sanitized_path)
@@ -55,6 +74,62 @@ def sanitize_url_path_for_filename(path):
 
     return sanitized_path
 
+class RateLimiter:
+    """Async token bucket allowing `requests_per_second` acquisitions on average."""
+
+    def __init__(self, requests_per_second, burst=1):
+        self.rate = requests_per_second
+        self.capacity = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Waits until a token is available, then consumes it."""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                # Refill tokens for the time elapsed since the last update
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+@lru_cache(maxsize=None)
+def ensure_directory(path):
+    """Creates a directory (and parents) if missing. Cached, so each path costs one syscall per run."""
+    os.makedirs(path, exist_ok=True)
+
+class FirecrawlTransientError(Exception):
+    """Raised for Firecrawl responses worth retrying (HTTP 429 and 5xx)."""
+
+class FirecrawlAuthError(Exception):
+    """Raised when Firecrawl rejects the API key (HTTP 401). Stops the whole run."""
+
+def write_markdown_file(path, content):
+    """Writes markdown content to a file. Runs on the I/O thread pool.
+
+    The content goes to a temporary file that is then atomically renamed, so
+    an interrupted run never leaves a partial file that would be skipped
+    as "already exists" next time.
+    """
+    # Fixed temp name next to the target: output paths are unique within a run,
+    # and a leftover from a crashed run is simply overwritten next time
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        # Don't leave stray .tmp files in the output folder
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
 # --- Check Configuration ---
 if not API_KEY:
     print("❌ ERROR: FIRECRAWL_API_KEY not found in environment variables or .env file.")
@@ -66,65 +141,108 @@ if not API_URL:
      print("Please set the API_URL environment variable or add API_URL='your_api_url_here' to a .env file in the script directory.")
      exit(1)
 
-print("✅ Configuration loaded.")
-
-# --- Initialize FirecrawlApp ---
 try:
-    app = FirecrawlApp(api_key=API_KEY, api_url=API_URL)
-    print("✅ FirecrawlApp initialized.")
-except Exception as e:
-    print(f"❌ ERROR: Failed to initialize FirecrawlApp. Details: {e}")
-    # Check for common API key errors
-    if "Unauthorized" in str(e):
-        print("   Possible cause: Invalid or expired API key.")
+    MAX_AGE_MS = int(MAX_AGE_MS)
+    if MAX_AGE_MS < 0:
+        raise ValueError
+except ValueError:
+    print(f"❌ ERROR: FIRECRAWL_MAX_AGE must be a whole number of milliseconds (0 or more), got '{MAX_AGE_MS}'.")
+    print("Please fix or remove the FIRECRAWL_MAX_AGE environment variable or the FIRECRAWL_MAX_AGE entry in the .env file.")
     exit(1)
 
+print("✅ Configuration loaded.")
+
+# Firecrawl REST endpoint used for every scrape
+SCRAPE_ENDPOINT = f"{API_URL.rstrip('/')}/v1/scrape"
+
 # --- Load URLs ---
 try:
-    with open(INPUT_FILENAME, 'r', encoding='utf-8') as file:
-        urls = [line.strip() for line in file if line.strip()]
+    # Read the whole file in one call and strip each line only once
+    lines = Path(INPUT_FILENAME).read_text(encoding='utf-8').splitlines()
+    urls = [url for url in map(str.strip, lines) if url]
     if not urls:
         print(f"⚠️ No URLs found in input file '{INPUT_FILENAME}'.")
         exit(0)
     print(f"📄 Loaded {len(urls)} URLs from '{INPUT_FILENAME}'.")
     total_urls_loaded = len(urls) # Keep track of the total loaded
+
+    # Drop duplicate URLs (keeping first-seen order) so no page is scraped twice.
+    # Each URL keeps its 1-based position in the input file, which truncated
+    # filenames use, so they stay the same as in runs without deduplication.
+    url_positions = {}
+    for idx, url in enumerate(urls, start=1):
+        url_positions.setdefault(url, idx)
+    urls = list(url_positions)
+    skipped_duplicate_count = total_urls_loaded - len(urls)
+    if skipped_duplicate_count:
+        print(f"🔁 Removed {skipped_duplicate_count} duplicate URLs.")
 except FileNotFoundError:
     print(f"❌ ERROR: Input file '{INPUT_FILENAME}' not found in the script directory.")
     print(f"Make sure '{INPUT_FILENAME}' is in the same directory as the script.")
     exit(1)
 
 # --- Ensure Main Output Directory Exists ---
-if not os.path.exists(MAIN_OUTPUT_DIRECTORY):
-    try:
-        os.makedirs(MAIN_OUTPUT_DIRECTORY)
-        print(f"📁 Created main output directory: {MAIN_OUTPUT_DIRECTORY}")
-    except Exception as e:
-        print(f"❌ ERROR: Could not create main output directory '{MAIN_OUTPUT_DIRECTORY}'. {e}")
-        exit(1)
-else:
-     print(f"📁 Main output directory already exists: {MAIN_OUTPUT_DIRECTORY}")
+try:
+    ensure_directory(MAIN_OUTPUT_DIRECTORY)
+    print(f"📁 Using main output directory: {MAIN_OUTPUT_DIRECTORY}")
+except Exception as e:
+    print(f"❌ ERROR: Could not create main output directory '{MAIN_OUTPUT_DIRECTORY}'. {e}")
+    exit(1)
 
+# --- Index Existing Output Files ---
+# One directory walk up front, so the per-URL "already exists" check is a set lookup.
+# Paths are compared the way the filesystem does: on case-insensitive filesystems
+# (default on macOS and Windows) '/About' and '/about' are the same file.
+# os.path.normcase only folds case on Windows, so also probe the output folder itself.
+swapped_output_directory = MAIN_OUTPUT_DIRECTORY.swapcase()
+CASE_INSENSITIVE_OUTPUT = (swapped_output_directory != MAIN_OUTPUT_DIRECTORY
+                           and os.path.exists(swapped_output_directory))
+
+def path_key(path):
+    """Returns the key used to compare output paths in existing_files."""
+    path = os.path.normcase(path)
+    return path.lower() if CASE_INSENSITIVE_OUTPUT else path
+
+existing_files = {path_key(os.path.join(dirpath, filename))
+                  for dirpath, _, filenames in os.walk(MAIN_OUTPUT_DIRECTORY)
+                  for filename in filenames}
+print(f"🗂️ Found {len(existing_files)} existing output files.")
+
+
+# --- REQUIREMENT 1: Ignore PDF URLs ---
+# Partition once up front instead of checking inside the processing loop
+# Only the 4-char suffix is lowercased, not the whole URL, and each URL is checked once
+pdf_urls = []
+real_urls = []
+for url in urls:
+    if url[-4:].lower() == '.pdf':
+        pdf_urls.append(url)
+    else:
+        real_urls.append(url)
 
 # --- Initialize Stats Counters ---
-skipped_pdf_count = 0
+skipped_pdf_count = len(pdf_urls)
 skipped_exists_count = 0
 error_count = 0
 successfully_scraped_count = 0
 
-# --- Process Each URL ---
+# --- Resolve Output Paths ---
+# Pre-pass: filter out PDFs and already-saved pages, and remember where each
+# remaining URL should be written once it has been scraped.
+output_paths = {} # Maps each URL to scrape -> its output file path
+url_domains = {} # Maps each URL to scrape -> its registrable domain (for rate limiting)
 print("\nStarting processing...")
-for idx, url in enumerate(urls, start=1):
-    print(f"\n[{idx}/{total_urls_loaded}] Processing: {url}")
+for url in pdf_urls:
+    print(f"   ➡️ Skipping URL ending in .pdf: {url}")
 
-    # --- REQUIREMENT 1: Ignore PDF URLs ---
-    if url.lower().endswith('.pdf'):
-        print(f"   ➡️ Skipping URL ending in .pdf: {url}")
-        skipped_pdf_count += 1 # Increment PDF skip counter
-        continue # Skip to the next URL in the loop
+for url in real_urls:
+    idx = url_positions[url]
+    print(f"\n[{idx}/{total_urls_loaded}] Processing: {url}")
 
     try:
         # --- Extract Registrable Domain using tldextract ---
-        extracted = tldextract.extract(url)
+        # Given the raw URL, tldextract handles ports, userinfo and missing schemes itself
+        extracted = TLD_EXTRACTOR(url)
 
         # Check if tldextract successfully found domain and suffix
         if not extracted.domain or not extracted.suffix:
@@ -142,15 +260,13 @@ for idx, url in enumerate(urls, start=1):
         # --- Construct Domain-Specific Output Directory ---
         DOMAIN_OUTPUT_DIRECTORY = os.path.join(MAIN_OUTPUT_DIRECTORY, main_domain)
 
-        # Ensure the domain-specific directory exists
-        if not os.path.exists(DOMAIN_OUTPUT_DIRECTORY):
-            try:
-                os.makedirs(DOMAIN_OUTPUT_DIRECTORY)
-                print(f"   Created domain directory: {DOMAIN_OUTPUT_DIRECTORY}")
-            except Exception as e:
-                print(f"   ❌ ERROR: Could not create domain directory '{DOMAIN_OUTPUT_DIRECTORY}'. Skipping URL. {e}")
-                error_count += 1 # Count this as an error
-                continue # Skip processing this URL if directory creation failed
+        # Ensure the domain-specific directory exists (only hits the filesystem once per domain)
+        try:
+            ensure_directory(DOMAIN_OUTPUT_DIRECTORY)
+        except Exception as e:
+            print(f"   ❌ ERROR: Could not create domain directory '{DOMAIN_OUTPUT_DIRECTORY}'. Skipping URL. {e}")
+            error_count += 1 # Count this as an error
+            continue # Skip processing this URL if directory creation failed
 
         # --- Generate Filename from URL Path ---
         parsed_url = urlparse(url)
@@ -159,50 +275,163 @@ for idx, url in enumerate(urls, start=1):
         output_filename = f"{filename_base}.md"
 
         # Ensure the filename isn't excessively long (some OS limits)
-        MAX_FILENAME_LEN = 200 # A common safe limit, adjust if needed
         if len(output_filename) > MAX_FILENAME_LEN:
             # Truncate and maybe add a hash to avoid collisions if needed
             # For simplicity, let's just truncate and add the index as a fallback identifier
             print(f"   ⚠️ Generated filename is too long ({len(output_filename)} chars), truncating.")
             # Keep the .md extension and leave space for index + underscore
-            truncated_base = filename_base[:MAX_FILENAME_LEN - len('.md') - len(str(idx)) - 1]
-            output_filename = f"{truncated_base}_{idx}.md"
+            idx_str = str(idx)
+            truncated_base = filename_base[:MAX_FILENAME_BASE_LEN - len(idx_str) - 1]
+            output_filename = f"{truncated_base}_{idx_str}.md"
 
 
         output_path = os.path.join(DOMAIN_OUTPUT_DIRECTORY, output_filename)
 
         # --- REQUIREMENT 2: Skip if output file already exists ---
-        if os.path.exists(output_path):
+        if path_key(output_path) in existing_files:
             print(f"   ✅ Output file already exists: {output_path}. Skipping scraping.")
             skipped_exists_count += 1 # Increment exists skip counter
             continue # Skip the API call and file writing, move to next URL
 
+        # --- Queue for scraping (only if not a PDF and the file doesn't exist) ---
+        output_paths[url] = output_path
+        url_domains[url] = main_domain
+        # Claim the path, so other URLs mapping to the same file (e.g. http vs https,
+        # a trailing '/', a different query) are skipped instead of scraped again
+        existing_files.add(path_key(output_path))
+        print(f"   📝 Queued for scraping -> {output_path}")
 
-        # --- Only scrape if it's not a PDF and the file doesn't exist ---
-        print(f"   🌍 Crawling URL with Firecrawl: {url}") # Indicate when API call happens
-        response = app.scrape_url(url, formats=["markdown"])
+    except Exception as e:
+        print(f"   ❌ ERROR processing {url}: {e}") # Changed 'scraping' to 'processing'
+        error_count += 1 # Increment error counter
 
-        # The response object directly has attributes like .markdown, .html, .data, etc.
-        markdown_content = response.markdown
+# --- Scrape Concurrently with Firecrawl ---
+# All requests share one aiohttp session, so TCP/TLS connections and DNS
+# lookups to the Firecrawl API are reused across URLs. The event loop keeps
+# up to MAX_CONCURRENT_SCRAPES requests in flight.
+MAX_CONCURRENT_SCRAPES = 20
+REQUEST_TIMEOUT_SECONDS = 60
+MAX_SCRAPE_ATTEMPTS = 3 # Total tries per URL for transient failures
+
+# File writes go to a dedicated thread pool so disk I/O never blocks the event loop
+IO_POOL_WORKERS = 8
+io_pool = ThreadPoolExecutor(max_workers=IO_POOL_WORKERS)
+
+# Per-domain limits, so concurrent scrapes don't hammer a single university site.
+# A task waits for its domain's slot and rate-limit token before taking one of
+# the global slots, so a busy domain never ties up slots other domains could use.
+DOMAIN_REQUESTS_PER_SECOND = 2
+MAX_CONCURRENT_PER_DOMAIN = 1 # At most one page per domain in flight
+limiters = defaultdict(lambda: RateLimiter(requests_per_second=DOMAIN_REQUESTS_PER_SECOND))
+domain_slots = defaultdict(lambda: asyncio.Semaphore(MAX_CONCURRENT_PER_DOMAIN))
+
+async def scrape_markdown(session, url, domain, sem):
+    """Scrapes a URL through the Firecrawl API and returns its markdown (or None).
+
+    Timeouts, connection errors, rate limiting (429) and server errors (5xx)
+    are retried with exponential backoff; any other error is raised at once.
+    Every attempt waits for the domain's slot and rate-limit token, then holds
+    one of the global `sem` slots only while the request is in flight.
+    """
+    payload = {"url": url, "formats": ["markdown"], "maxAge": MAX_AGE_MS}
+    for attempt in range(MAX_SCRAPE_ATTEMPTS):
+        try:
+            async with domain_slots[domain]:
+                # Retries hit the same site, so they count against its rate limit too
+                await limiters[domain].acquire()
+                async with sem:
+                    print(f"   🌍 Crawling URL with Firecrawl: {url}") # Indicate when API call happens
+                    async with session.post(SCRAPE_ENDPOINT, json=payload) as r:
+                        if r.status == 429 or r.status >= 500:
+                            raise FirecrawlTransientError(f"Firecrawl returned HTTP {r.status}")
+                        status = r.status
+                        body = await r.text()
+            break
+        except (asyncio.TimeoutError, aiohttp.ClientError, FirecrawlTransientError) as e:
+            if attempt == MAX_SCRAPE_ATTEMPTS - 1:
+                raise
+            delay = (2 ** attempt) + random.random() # Exponential backoff with jitter
+            print(f"   🔄 Retrying {url} in {delay:.1f}s (attempt {attempt + 1}/{MAX_SCRAPE_ATTEMPTS} failed: {e!r})")
+            await asyncio.sleep(delay) # No slots are held while backing off
+
+    if status == 401:
+        raise FirecrawlAuthError(f"Firecrawl returned HTTP {status} (unauthorized)")
+
+    # Check the status before trusting the body: a wrong API_URL or a proxy
+    # error page returns HTML, not JSON
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        raise RuntimeError(f"Firecrawl returned HTTP {status} with a non-JSON response: {body[:200]!r}")
+    if status != 200 or not data.get("success"):
+        raise RuntimeError(f"Firecrawl returned HTTP {status}: {data.get('error')}")
+    return data.get("data", {}).get("markdown")
+
+async def process(session, url, output_path, sem):
+    """Scrapes a single URL and saves its markdown. Returns 'success' or 'error'."""
+    try:
+        markdown_content = await scrape_markdown(session, url, url_domains[url], sem)
 
         if not markdown_content:
             print(f"   ⚠️ No markdown content returned for: {url}")
-            error_count += 1 # Count empty content as an error/failure
-            continue
-
+            return 'error' # Count empty content as an error/failure
 
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(markdown_content)
-        print(f"   💾 Saved: {output_path}") # Changed print for clarity
-        successfully_scraped_count += 1 # Increment success counter
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(io_pool, write_markdown_file, output_path, markdown_content)
+        print(f"   💾 Saved: {output_path}")
+        return 'success'
 
+    except FirecrawlAuthError:
+        raise # Every other request would fail the same way; let scrape_all stop the run
     except Exception as e:
-        print(f"   ❌ ERROR processing {url}: {e}") # Changed 'scraping' to 'processing'
-        error_count += 1 # Increment error counter
+        print(f"   ❌ ERROR processing {url}: {e}")
+        return 'error'
+
+async def scrape_all(output_paths):
+    """Runs process() for every queued URL and returns the list of results."""
+    sem = asyncio.Semaphore(MAX_CONCURRENT_SCRAPES)
+    connector = aiohttp.TCPConnector(limit=50, limit_per_host=MAX_CONCURRENT_SCRAPES,
+                                     ttl_dns_cache=300, keepalive_timeout=60)
+    async with aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS),
+        headers={"Authorization": f"Bearer {API_KEY}"},
+    ) as session:
+        tasks = [asyncio.create_task(process(session, url, output_path, sem))
+                 for url, output_path in output_paths.items()]
+        try:
+            return await asyncio.gather(*tasks)
+        except FirecrawlAuthError:
+            # Cancel the remaining scrapes instead of repeating the same 401 for every URL
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+if output_paths:
+    print(f"\n🌍 Scraping {len(output_paths)} URLs (up to {MAX_CONCURRENT_SCRAPES} at a time)...")
+    try:
+        results = asyncio.run(scrape_all(output_paths))
+    except FirecrawlAuthError as e:
+        print(f"❌ ERROR: Firecrawl rejected the request. Details: {e}")
+        print("   Possible cause: Invalid or expired API key.")
+        exit(1)
+    finally:
+        io_pool.shutdown(wait=True) # Make sure every pending write has finished
+
+    # Tally results after all tasks finish, so no counters are shared between tasks
+    for result in results:
+        if result == 'success':
+            successfully_scraped_count += 1 # Increment success counter
+        else:
+            error_count += 1 # Increment error counter
 
 # --- Print Run Statistics ---
 print("\n--- 📊 Run Statistics ---")
 print(f"🔗 Total URLs Loaded: {total_urls_loaded}")
+print(f"🔁 Skipped (Duplicate): {skipped_duplicate_count}")
 print(f"➡️ Skipped (PDF): {skipped_pdf_count}")
 print(f"⏭️ Skipped (Already Exists): {skipped_exists_count}")
 print(f"✅ Successfully Scraped & Saved: {successfully_scraped_count}")